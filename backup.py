@@ -1,13 +1,28 @@
 #!/usr/bin/env python2
+import fnmatch
 import optparse
 import os
+import pipes
 import re
+import shutil
 import socket
+import stat
 import sys
+import tempfile
 import time
+import urllib
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 VERSION = '0.8'
 
 # TODO: put config in a separate file
@@ -15,6 +30,7 @@ VERBOSE = 1
 
 HOST = socket.gethostname().split('.')[0]
 SSH_HOST = "lambda-backup"
+SSH = "ssh"
 REMOTE_DIR = "/home/andy/backup/T-disk/snapshot"
 CUR_SNAP = "daily.0"
 LOCAL_CHECK_DIR = "/home/andy/Private/.ssh/"
@@ -22,13 +38,32 @@ LOCAL_CHECK_DIR = "/home/andy/Private/.ssh/"
 SOURCES = [("/home", ['.gvfs/']),
            ("/usr/local", [])]
 # TODO: run rsync of ~/.Private with -W?
+# how many SOURCES to transfer at once
+RSYNC_JOBS = 2
+
+# Where the stat of every file backed up from each source is kept, so that
+# the next run can send just the changes. A run more than FULL_SWEEP_DAYS
+# after the last full one lets rsync compare everything.
+MANIFEST_DIR = "/var/cache/backup"
+FULL_SWEEP_DAYS = 7
 # TODO: more sane per-source ignore list (for .gvfs)
 
 EXPIRE_DAYS = [('daily', 14),
                ('monthly', None)]
 
+# Expired snapshots are moved into this directory of REMOTE_DIR, and then
+# deleted in the background at the REAP_IONICE I/O priority.
+TRASH = ".trash"
+REAP_IONICE = 'idle'
+IONICE_CLASSES = {'idle': 'ionice -c3 ',
+                  'best-effort': 'ionice -c2 -n7 ',
+                  'none': ''}
+
 DRY_RUN = False
 
+# control socket of the master ssh connection, set by ssh_master
+SSH_CONTROL_PATH = None
+
 def log(message):
     # TODO: implement this
     # logger -t "$SCRIPT[$$]" "$*"
@@ -43,9 +78,6 @@ def vlog(message):
     if VERBOSE:
         print message
 
-class DoesNotExist(Exception):
-    pass
-
 class BackupError(Exception):
     def __init__(self, *args):
         args = args[:2]
@@ -114,10 +146,11 @@ class SshError(CommandError):
         command -- the command executed
     """
 
-def run(arglist, raise_err=False, ssh_err=False):
+def run(arglist, raise_err=False, ssh_err=False, stdin=None):
     """Run a command, optionally raising an exception on errors."""
-    p = Popen(arglist, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
+    p = Popen(arglist, stdin=None if stdin is None else PIPE,
+              stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate(stdin)
 
     if raise_err and p.returncode != 0:
         if ssh_err and p.returncode == 255:
@@ -132,6 +165,14 @@ def run_safe(arglist):
     """Convenience function to call run() and raise an exception on errors."""
     run(arglist, raise_err=True)
 
+def ssh_args():
+    """Return the ssh command, using the master connection if there is one."""
+    args = [SSH]
+    if SSH_CONTROL_PATH:
+        args += ['-o', 'ControlMaster=no',
+                 '-o', 'ControlPath=' + SSH_CONTROL_PATH]
+    return args
+
 def ssh(command, raise_err=False, dry_safe=True):
     """Use run() to ssh to SSH_HOST and run command."""
     if DRY_RUN and not dry_safe:
@@ -140,7 +181,8 @@ def ssh(command, raise_err=False, dry_safe=True):
         return None
 
     vlog('+ (ssh) ' + command)
-    return run(['ssh', SSH_HOST, command], raise_err=raise_err, ssh_err=True)
+    return run(ssh_args() + [SSH_HOST, command], raise_err=raise_err,
+               ssh_err=True)
 
 def ssh_safe(command):
     """Convenience function to call ssh() and raise an exception on errors."""
@@ -150,6 +192,54 @@ def ssh_dry(command):
     """Convenience function to call ssh() for a command unsafe for dry runs."""
     return ssh(command, raise_err=True, dry_safe=False)
 
+class ssh_master(object):
+    """
+    A context manager holding one ssh connection to SSH_HOST open, which
+    ssh() and rsync share instead of each connecting afresh.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.tmpdir = None
+        self.proc = None
+
+    def __enter__(self):
+        """Connect, and wait until the control socket is ready."""
+        global SSH_CONTROL_PATH
+        self.tmpdir = tempfile.mkdtemp(prefix='backup-ssh.')
+        control_path = os.path.join(self.tmpdir, 'control')
+        cmd = [SSH, '-N', '-o', 'ControlMaster=yes',
+               '-o', 'ControlPath=' + control_path, SSH_HOST]
+        vlog('+ ' + ' '.join(cmd))
+        # stderr is left alone so that any password prompt is seen
+        self.proc = Popen(cmd, stdin=open(os.devnull), stdout=PIPE)
+
+        check = [SSH, '-O', 'check', '-o', 'ControlPath=' + control_path,
+                 SSH_HOST]
+        deadline = time.time() + self.timeout
+        while not run(check):
+            if self.proc.poll() is not None or time.time() > deadline:
+                self.__exit__()
+                logerr("ERROR: Cannot connect to %s." % SSH_HOST)
+                raise SshError(self.proc.returncode or 255, cmd)
+            time.sleep(0.1)
+
+        SSH_CONTROL_PATH = control_path
+        return self
+
+    def __exit__(self, *exc_info):
+        """Disconnect."""
+        global SSH_CONTROL_PATH
+        if self.proc.poll() is None:
+            run([SSH, '-O', 'exit', '-o',
+                 'ControlPath=' + os.path.join(self.tmpdir, 'control'),
+                 SSH_HOST])
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+        SSH_CONTROL_PATH = None
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
 # =====================
 # Main backup functions
 
@@ -197,19 +287,15 @@ def check_local_dir_exists():
         logerr("ERROR: Local check directory doesn't exist.")
         raise BackupError(4, 'check_local_dir_exists() failed')
 
-def get_snap_mtime(snap):
-    path = '"%s/%s"' % (REMOTE_DIR, snap)
-    try:
-        result = ssh_safe('/usr/bin/stat --format="%Y" ' + path)
-    except CommandError, e:
-        if e.stderr.endswith('No such file or directory\n'):
-            vlog('stat: %s: No such file or directory' % snap)
-            raise DoesNotExist
-        else:
-            raise
-
-    seconds_since_epoch = int(result.stdout.strip())
-    return datetime.fromtimestamp(seconds_since_epoch)
+def get_snap_mtimes():
+    """Return the mtime of everything in REMOTE_DIR by name, in one listing."""
+    result = ssh_safe('find "%s" -mindepth 1 -maxdepth 1 -printf "%%T@ %%f\\n"'
+                      % REMOTE_DIR)
+    mtimes = {}
+    for line in result.stdout.splitlines():
+        stamp, name = line.split(' ', 1)
+        mtimes[name] = datetime.fromtimestamp(int(float(stamp)))
+    return mtimes
 
 def get_snap_num_factory(prefix):
     def get_snap_num(name):
@@ -217,20 +303,79 @@ def get_snap_num_factory(prefix):
         return int(name[len(prefix):])
     return get_snap_num
 
-def list_snaps(stype, sort=True):
-    """List snapshots from given series (e.g. daily) in sorted order."""
-    result = ssh_safe('ls "%s"' % REMOTE_DIR)
-    snaps = result.stdout.split('\n')
-    snaps = [x for x in snaps if x.startswith(stype + '.')]
+class SnapPlan(object):
+    """
+    Snapshot renames, hard links and deletions, planned against one listing
+    of REMOTE_DIR and then run remotely as a single command. Each operation
+    updates the listing, so later ones see the snapshots as they will be.
+    """
 
-    if sort:
-        getnum = get_snap_num_factory(stype + '.')
-        snaps.sort(key=getnum)
+    def __init__(self, mtimes=None):
+        if mtimes is None:
+            mtimes = get_snap_mtimes()
+        self.mtimes = mtimes
+        self.commands = []
+
+    def list_snaps(self, stype, sort=True):
+        """List snapshots from given series (e.g. daily) in sorted order."""
+        snaps = [x for x in self.mtimes if re.match(r'%s\.\d+$' % stype, x)]
+
+        if sort:
+            getnum = get_snap_num_factory(stype + '.')
+            snaps.sort(key=getnum)
+
+        return snaps
+
+    def rename(self, source, dest):
+        self.commands.append('mv -vT "%s/%s" "%s/%s"' % (REMOTE_DIR, source,
+                                                        REMOTE_DIR, dest))
+        self.mtimes[dest] = self.mtimes.pop(source)
+
+    def hard_link(self, source, dest):
+        # cp -a keeps the mtime of source
+        self.commands.append('cp -al "%s/%s" "%s/%s"' % (REMOTE_DIR, source,
+                                                        REMOTE_DIR, dest))
+        self.mtimes[dest] = self.mtimes[source]
+
+    def delete(self, snap):
+        """Move snap into the trash, which run() then empties."""
+        assert(snap != '')
+        trash = '%s/%s' % (REMOTE_DIR, TRASH)
+        if TRASH not in self.mtimes:
+            self.commands.append('mkdir -p "%s"' % trash)
+            self.mtimes[TRASH] = datetime.now()
+        self.commands.append('mv -T "%s/%s" "%s/%s.%d"' % (
+            REMOTE_DIR, snap, trash, snap, time.time()))
+        del self.mtimes[snap]
+
+    def run(self):
+        """
+        Run the planned commands, stopping at the first that fails. Then
+        start emptying the trash, without waiting for it.
+        """
+        commands = self.commands
+        if TRASH in self.mtimes:
+            commands = commands + ['{ %s & }' % reap_command()]
+        if commands:
+            ssh_dry(' && '.join(commands))
+            self.commands = []
+
+def reap_command():
+    """
+    Return a command deleting everything in the trash at the REAP_IONICE
+    priority, detached so that ssh returns at once.
+    """
+    return ('nohup %srm -rf "%s/%s"/* </dev/null >/dev/null 2>&1'
+            % (IONICE_CLASSES[REAP_IONICE], REMOTE_DIR, TRASH))
 
-    return snaps
+def rotate_snaps(stype='daily', hard_link=True, plan=None):
+    if plan is None:
+        plan = SnapPlan()
+        rotated = rotate_snaps(stype, hard_link, plan)
+        plan.run()
+        return rotated
 
-def rotate_snaps(stype='daily', hard_link=True):
-    snaps = list_snaps(stype)
+    snaps = plan.list_snaps(stype)
     getnum = get_snap_num_factory(stype + '.')
     snapnums = map(getnum, snaps)
 
@@ -240,67 +385,52 @@ def rotate_snaps(stype='daily', hard_link=True):
 
     # increment number of each snapshot by renaming it
     for i in reversed(snapnums):
-        snapfrom = "%s/%s.%d" % (REMOTE_DIR, stype, i)
-        snapto   = "%s/%s.%d" % (REMOTE_DIR, stype, i + 1)
-        ssh_dry('mv -vT "%s" "%s"' % (snapfrom, snapto))
+        plan.rename("%s.%d" % (stype, i), "%s.%d" % (stype, i + 1))
 
     if hard_link:
         recent_num = snapnums[0] + 1
         # hardlink most recent snapshot to snapshot.0
-        snap_hard_link("%s.%d" % (stype, recent_num), "%s.0" % stype)
+        plan.hard_link("%s.%d" % (stype, recent_num), "%s.0" % stype)
 
     return True
 
-def snap_hard_link(source, dest):
-    return ssh_dry('cp -al "%s/%s" "%s/%s"' % (REMOTE_DIR, source,
-                                               REMOTE_DIR, dest))
-
-def snap_delete(snap, verbose=False):
-    assert(snap != '')
-    opts = '-v ' if verbose else ''
-    return ssh_dry('rm -rf ' + opts + '"%s/%s"' % (REMOTE_DIR, snap))
-
-def find_snaps(stype, mtime):
-    result = ssh_safe('find "%s" -maxdepth 1 -name "%s.*" -mtime "%s"' %
-                      (REMOTE_DIR, stype, mtime))
-    snaps = filter(None, result.stdout.split('\n'))
-    return map(os.path.basename, snaps)
-
-def snap_cleanup():
-    """Clean up old snapshots according to EXPIRE_DAYS schedule."""
+def snap_cleanup(plan):
+    """Plan removal of old snapshots according to EXPIRE_DAYS schedule."""
     vlog('Cleaning out old snapshots...')
+    now = datetime.now()
     count = 0
     for stype, expire_days in EXPIRE_DAYS:
         if expire_days is None:
             continue
-        for snap in find_snaps(stype, '+%d' % expire_days):
+        for snap in plan.list_snaps(stype):
+            # as find -mtime +expire_days would
+            if (now - plan.mtimes[snap]).days <= expire_days:
+                continue
             if snap.endswith('.0'):
                 # don't remove the last snapshot of any series
                 continue
             count += 1
-            snap_delete(snap)
+            plan.delete(snap)
 
     return count
 
-def snap_archive_monthly():
+def snap_archive_monthly(plan):
     """
-    If there is no monthly snapshot for the current month, rotate the monthly
-    snapshots and hard link the most recent daily snapshot to monthly.0.
+    If there is no monthly snapshot for the current month, plan rotating the
+    monthly snapshots and hard linking the most recent daily snapshot to
+    monthly.0.
     """
     vlog('Archiving new monthly.0 as needed...')
     now = datetime.now()
 
-    try:
-        last_monthly = get_snap_mtime('monthly.0')
-    except DoesNotExist:
-        pass
-    else:
+    last_monthly = plan.mtimes.get('monthly.0')
+    if last_monthly is not None:
         if last_monthly.year == now.year and last_monthly.month == now.month:
             vlog('monthly.0 is from the current month.')
             return
 
-    for snap in reversed(list_snaps('daily')):
-        mtime = get_snap_mtime(snap)
+    for snap in reversed(plan.list_snaps('daily')):
+        mtime = plan.mtimes[snap]
         if mtime.month == now.month and mtime.year == now.year:
             # found the first daily of this month
             break
@@ -309,13 +439,158 @@ def snap_archive_monthly():
         return
 
     vlog('Rotating monthly snapshots...')
-    rotate_snaps('monthly', hard_link=False)
+    rotate_snaps('monthly', hard_link=False, plan=plan)
 
     vlog('Saving %s to monthly.0...' % snap)
-    snap_hard_link(snap, 'monthly.0')
+    plan.hard_link(snap, 'monthly.0')
     return True
 
-def do_rsync(source, excludes):
+def is_excluded(path, name, is_dir, excludes):
+    """
+    Approximate rsync's matching of exclude patterns, never excluding more
+    than rsync would: a pattern with a slash matches the last components of
+    the path (or all of them, if it starts with a slash), else just the
+    name, and one ending in a slash only matches directories. As in rsync,
+    a single * doesn't match across a slash. Patterns with ** are left to
+    rsync, which applies the real rules to whatever this lets through.
+    """
+    for pattern in excludes:
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip('/')
+        if '**' in pattern:
+            continue
+        if '/' in pattern:
+            parts = pattern.lstrip('/').split('/')
+            names = path.lstrip('/').split('/')
+            if pattern.startswith('/') and len(names) != len(parts):
+                continue
+            if len(names) >= len(parts) and all(
+                    fnmatch.fnmatch(n, p)
+                    for n, p in zip(names[-len(parts):], parts)):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def walk_tree(top, excludes):
+    """
+    Yield (path, attrs) for top and everything under it on the same file
+    system, as rsync -x sees it, where attrs is a string of the mtime, ctime
+    and size. Uses scandir where it is available.
+    """
+    top_st = os.lstat(top)
+    yield top, '%r %r %d' % (top_st.st_mtime, top_st.st_ctime,
+                             top_st.st_size)
+    dirs = [top]
+    while dirs:
+        parent = dirs.pop()
+        try:
+            if scandir is not None:
+                entries = [(e.path, e.name, e.stat(follow_symlinks=False))
+                           for e in scandir(parent)]
+            else:
+                entries = [(os.path.join(parent, name), name,
+                            os.lstat(os.path.join(parent, name)))
+                           for name in os.listdir(parent)]
+        except OSError, e:
+            # rsync will report it too
+            logerr("WARNING: cannot scan %s: %s" % (parent, e))
+            continue
+        for path, name, st in entries:
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if is_excluded(path, name, is_dir, excludes):
+                continue
+            yield path, '%r %r %d' % (st.st_mtime, st.st_ctime, st.st_size)
+            if is_dir and st.st_dev == top_st.st_dev:
+                dirs.append(path)
+
+class Manifest(object):
+    """
+    The stat of every path under a source as of its last good backup, kept
+    in MANIFEST_DIR, and a fresh scan to compare it with.
+    """
+
+    def __init__(self, source, excludes):
+        self.source = source
+        self.filename = os.path.join(MANIFEST_DIR,
+                                     urllib.quote(source, '') + '.manifest')
+        vlog('Scanning %s...' % source)
+        self.entries = dict(walk_tree(source, excludes))
+
+    def load(self):
+        """Return the saved entries, or None if a full sweep is due."""
+        try:
+            age = time.time() - os.path.getmtime(self.filename)
+            if age > FULL_SWEEP_DAYS * 86400:
+                vlog('Last full sweep of %s was %d days ago'
+                     % (self.source, age // 86400))
+                return None
+            with open(self.filename) as f:
+                fields = f.read().split('\0')
+        except (IOError, OSError):
+            return None
+        return dict(zip(fields[0:-1:2], fields[1::2]))
+
+    def changes(self):
+        """
+        Return the paths changed or deleted since the saved manifest, or
+        None if there is none to go by. Deleted directories are given
+        without their contents.
+        """
+        old = self.load()
+        if old is None:
+            return None
+        changed = [path for path, attrs in self.entries.iteritems()
+                   if old.get(path) != attrs]
+        deleted = []
+        for path in sorted(set(old) - set(self.entries)):
+            if not deleted or not path.startswith(deleted[-1] + '/'):
+                deleted.append(path)
+        return sorted(changed + deleted)
+
+    def save(self, full):
+        """
+        Save the scan as the new manifest. Only after a full sweep does the
+        file get a new mtime, so the sweeps stay FULL_SWEEP_DAYS apart.
+        """
+        if not os.path.isdir(MANIFEST_DIR):
+            os.makedirs(MANIFEST_DIR, 0700)
+        mtime = None
+        if not full and os.path.exists(self.filename):
+            mtime = os.path.getmtime(self.filename)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            for path, attrs in self.entries.iteritems():
+                f.write(path + '\0' + attrs + '\0')
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, self.filename)
+
+def backup_source(source, excludes, incremental=False):
+    """
+    rsync source, sending only what changed since the last backup if
+    incremental, unless a full sweep is due.
+    """
+    manifest = Manifest(source, excludes)
+    files = manifest.changes() if incremental else None
+    if files is None:
+        do_rsync(source, excludes)
+    elif files:
+        vlog('%d paths in %s changed' % (len(files), source))
+        do_rsync(source, excludes, files)
+    else:
+        vlog('Nothing in %s changed' % source)
+
+    if not DRY_RUN:
+        manifest.save(full=files is None)
+
+def do_rsync(source, excludes, files=None):
+    """
+    rsync source to the current snapshot. If files is given, just those
+    paths are sent, and any that no longer exist are deleted.
+    """
     dest_dir = '/'.join((REMOTE_DIR, CUR_SNAP, HOST))
     dest = SSH_HOST + ':' + dest_dir
     vlog("Transferring %s to %s..." % (source, dest))
@@ -323,7 +598,7 @@ def do_rsync(source, excludes):
     # ensure remote directory exists
     ssh_dry('mkdir -p "%s"' % dest_dir)
 
-    opts = ['-axR', '-z']
+    opts = ['-axR', '-z', '-e', ' '.join(map(pipes.quote, ssh_args()))]
 
     if VERBOSE:
         opts.append('-v')
@@ -332,13 +607,23 @@ def do_rsync(source, excludes):
     if excludes:
         vlog("excluding: " + ', '.join(excludes))
 
-    cmd = ['rsync'] + opts + ['--numeric-ids', '--del', source, dest]
+    cmd = ['rsync'] + opts + ['--numeric-ids', '--del']
+    if files is None:
+        cmd += [source, dest]
+    else:
+        # the paths are relative to / and, with --files-from, rsync
+        # doesn't recurse into the directories among them
+        cmd += ['--files-from=-', '--from0', '--delete-missing-args',
+                '/', dest]
 
     if DRY_RUN:
         vlog('+ [DRY_RUN] ' + ' '.join(cmd))
         return True
-    else:
+    elif files is None:
         result = run(cmd)
+    else:
+        result = run(cmd, stdin=''.join(path.lstrip('/') + '\0'
+                                        for path in files))
 
     if result.returncode == 0:
         return True
@@ -350,18 +635,46 @@ def do_rsync(source, excludes):
             logerr('rsync: Broken pipe (network failure?)')
             logerr('Retrying...')
             # TODO: institute max_retries rather than hitting RecursionLimit
-            return do_rsync(source)
+            return do_rsync(source, excludes, files)
 
+    fd, outfile = tempfile.mkstemp(prefix='rsync.', suffix='.out')
     logerr("Rsync failed : " + source + " -> " + dest)
-    logerr("Writing stdout to /tmp/rsync.out")
-    # TODO: this is a security risk. write to randomly named file
-    f = open('/tmp/rsync.out', 'w')
+    logerr("Writing stdout to " + outfile)
+    f = os.fdopen(fd, 'w')
     f.write(result.stdout)
     f.close()
     logerr("stderr: '''" + result.stderr + "'''")
     raise CommandError(result.returncode, cmd)
 
+def rsync_sources(sources, jobs=RSYNC_JOBS, incremental=False):
+    """
+    Run backup_source for each (source, excludes) in sources, up to jobs at
+    once. A failed source doesn't stop the others; the failures are raised
+    together at the end. Failures include a source that can't be scanned
+    and a manifest that can't be saved.
+    """
+    def attempt(source):
+        try:
+            backup_source(source[0], source[1], incremental)
+        except (CommandError, EnvironmentError), e:
+            return e
+
+    pool = ThreadPool(jobs)
+    try:
+        errors = [(src, e) for (src, excludes), e
+                  in zip(sources, pool.map(attempt, sources)) if e]
+    finally:
+        pool.close()
+        pool.join()
+
+    for src, e in errors:
+        logerr("ERROR: backup of %s failed: %s" % (src, e))
+    if errors:
+        raise BackupError(6, '%d of %d sources failed' % (len(errors),
+                                                           len(sources)))
+
 def main():
+    global REAP_IONICE
     p = optparse.OptionParser(usage = '%prog [options]',
                               version = '%prog ' + VERSION)
     p.add_option('-n', '--dry-run', dest='dry_run', action='store_true',
@@ -376,6 +689,17 @@ def main():
                  help="rotate snapshots in SERIES (daily, etc.) and exit")
     p.add_option('--cleanup-only', dest='cleanup_only', action='store_true',
                  help="remove old snapshots and exit", default=False)
+    p.add_option('-j', '--jobs', dest='jobs', type='int', default=RSYNC_JOBS,
+                 metavar='N', help="transfer up to N sources at once"
+                                   " (default %default)")
+    p.add_option('--reap-ionice', dest='reap_ionice', metavar='CLASS',
+                 type='choice', choices=sorted(IONICE_CLASSES),
+                 default=REAP_IONICE,
+                 help="delete expired snapshots at this I/O priority: idle,"
+                      " best-effort or none (default %default)")
+    p.add_option('--full', dest='full', action='store_true', default=False,
+                 help="have rsync compare every file, not just those changed"
+                      " since the last backup")
     opts, args = p.parse_args()
 
     if opts.rotate_only and not opts.rotate:
@@ -384,11 +708,15 @@ def main():
         p.error("--no-cleanup and --clenaup-only are mutually exclusive")
     if opts.rotate_only and opts.cleanup_only:
         p.error("at most one --foo-only option may be supplied")
+    if opts.jobs < 1:
+        p.error("--jobs must be at least 1")
 
     if not opts.rotate:
         # --no-rotate implies --no-link
         opts.link = False
 
+    REAP_IONICE = opts.reap_ionice
+
     if opts.dry_run:
         global DRY_RUN
         vlog('DRY RUN')
@@ -396,27 +724,38 @@ def main():
 
     check_privs()
     check_local_dir_exists()
-    check_dir_exists()
 
+    with ssh_master():
+        check_dir_exists()
+        return backup(opts)
+
+def backup(opts):
     with snap_lock():
         if opts.rotate_only:
             vlog('Rotating snapshots in series %s...' % opts.rotate_only)
             rotate_snaps(opts.rotate_only, opts.link)
             return 0
 
+        # all the snapshot operations run as one remote command
+        plan = SnapPlan()
         if opts.cleanup:
-            snap_archive_monthly()
-            snap_cleanup()
+            snap_archive_monthly(plan)
+            snap_cleanup(plan)
             if opts.cleanup_only:
+                plan.run()
                 return 0
 
+        # sending just the changes relies on CUR_SNAP holding the last
+        # backup, either still or as a hard linked copy
+        incremental = not opts.full
         if opts.rotate:
             vlog('Rotating daily snapshots...')
-            rotate_snaps('daily', opts.link)
+            if not rotate_snaps('daily', opts.link, plan) or not opts.link:
+                incremental = False
+        plan.run()
 
         # actually take a backup
-        for src, excludes in SOURCES:
-            do_rsync(src, excludes)
+        rsync_sources(SOURCES, opts.jobs, incremental)
 
         ssh_dry('touch ' + REMOTE_DIR + '/' + CUR_SNAP)
         return 0
@@ -2,17 +2,63 @@
 
 """
 Print or check file checksums, modification times, and sizes.
-The MD5 algorithm is used for checksums by default.
+The MD5 algorithm is used for checksums by default. Several comma-separated
+algorithms may be given, in which case each file is read only once and the
+digests are printed separated by commas. Adding "-tree" to an algorithm name
+(e.g. sha256-tree) hashes ranges of each file in parallel and records the
+digest of every range, so that --check can report which ranges changed.
 """
 
-import errno
+import array
+import bisect
+import contextlib
+import copy
+import ctypes
+import ctypes.util
 import fcntl
+import fnmatch
 import hashlib
+import io
+import itertools
+import json
+import math
 import optparse
 import os
+import signal
+import stat
+import struct
+import subprocess
 import sys
+import threading
+import time
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from os import posix_fadvise, POSIX_FADV_DONTNEED
+except ImportError:
+    # Python 2 has no os.posix_fadvise, so call the C library's directly
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        _fadvise = _libc.posix_fadvise64
+        _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                             ctypes.c_int]
+    except (OSError, AttributeError):
+        posix_fadvise = None
+    else:
+        def posix_fadvise(fd, offset, length, advice):
+            _fadvise(fd, offset, length, advice)
+        # the value used by Linux on most architectures
+        POSIX_FADV_DONTNEED = 4
 
 HASH_LENGTHS = {
     32: 'md5',
@@ -23,6 +69,36 @@ HASH_LENGTHS = {
 
 BASENAME = os.path.basename(__file__)
 
+# Bytes to hash per read() call, set by --chunk-size.
+CHUNK_SIZE = 1024 * 1024
+
+# Tree hash algorithms (e.g. sha256-tree) split files into ranges of
+# LEAF_SIZE bytes, set by --leaf-size, and hash up to TREE_JOBS ranges of a
+# file at once, set by --jobs.
+TREE_SUFFIX = '-tree'
+LEAF_SIZE = 64 * 1024 * 1024
+TREE_JOBS = 1
+
+# struct fiemap followed by a single struct fiemap_extent (linux/fiemap.h)
+FIEMAP = struct.Struct('=QQLLLL' + 'QQQQQLLLL')
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_MAX_OFFSET = 2**64 - 1
+
+# Orders in which --check can read the listed files.
+CHECK_ORDERS = ('listed', 'inode', 'extent')
+
+# multipliers for the suffixes of a --scrub size
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# suffix of the file recording the directories a --watch is watching, and
+# as lines starting with '-', the paths under them that have gone since
+WATCH_SUFFIX = '.watch'
+
+# with --scrub, a Throttle limiting how fast files are read, and whether to
+# drop the pages read from the page cache
+THROTTLE = None
+DROP_CACHE = False
+
 class HasherError(Exception):
     pass
 
@@ -40,7 +116,195 @@ class DigestMismatch(VerificationError):
 class FailedOpen(VerificationError):
     pass
 
+class Stats(object):
+    """
+    Thread-safe counters and timers for the --stats report and --progress.
+
+    Phase times for stat and digest are summed over all worker threads, so
+    with --jobs they may exceed the elapsed wall time.
+    """
+
+    PHASES = ('load', 'stat', 'digest', 'save')
+
+    # upper bounds in seconds of the per-file digest latency buckets
+    LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1, 10, 100)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.files_hashed = 0
+        self.cache_hits = 0
+        self.files_done = 0
+        self.bytes_hashed = 0
+        self.latencies = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        # algorithm -> [bytes, seconds]
+        self.algorithms = {}
+        # totals for the ETA, if known
+        self.total_files = None
+        self.total_bytes = None
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[phase] += elapsed
+
+    def add_bytes(self, nbytes):
+        with self.lock:
+            self.bytes_hashed += nbytes
+
+    def add_digest(self, algorithm, nbytes, seconds):
+        with self.lock:
+            self.phases['digest'] += seconds
+            self.files_hashed += 1
+            bucket = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+            self.latencies[bucket] += 1
+            totals = self.algorithms.setdefault(algorithm, [0, 0.0])
+            totals[0] += nbytes
+            totals[1] += seconds
+
+    def add_hit(self):
+        with self.lock:
+            self.cache_hits += 1
+
+    def add_done(self):
+        with self.lock:
+            self.files_done += 1
+
+    def expect(self, files, nbytes=None):
+        """Add to the total number of files and bytes used for the ETA."""
+        with self.lock:
+            self.total_files = (self.total_files or 0) + files
+            if nbytes is not None:
+                self.total_bytes = (self.total_bytes or 0) + nbytes
+
+    def report(self):
+        """Return the statistics as a dict suitable for JSON."""
+        with self.lock:
+            bounds = list(self.LATENCY_BUCKETS) + [None]
+            histogram = [{'max_seconds': bound, 'files': count}
+                         for bound, count in zip(bounds, self.latencies)]
+            algorithms = {}
+            for algorithm, (nbytes, seconds) in self.algorithms.iteritems():
+                algorithms[algorithm] = {
+                    'bytes': nbytes,
+                    'seconds': round(seconds, 6),
+                    'mb_per_s': round(nbytes / 1e6 / seconds, 3)
+                                if seconds else None,
+                }
+            return {
+                'elapsed_seconds': round(time.time() - self.start, 6),
+                'files_done': self.files_done,
+                'files_hashed': self.files_hashed,
+                'cache_hits': self.cache_hits,
+                'bytes_hashed': self.bytes_hashed,
+                'phase_seconds': dict((k, round(v, 6))
+                                      for k, v in self.phases.iteritems()),
+                'latency_histogram': histogram,
+                'algorithms': algorithms,
+            }
+
+    def progress_line(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            line = '%d files done, %.1f MB hashed, %.1f MB/s' % (
+                self.files_done, self.bytes_hashed / 1e6,
+                self.bytes_hashed / 1e6 / elapsed if elapsed else 0)
+
+            if self.total_bytes and self.bytes_hashed:
+                fraction = float(self.bytes_hashed) / self.total_bytes
+            elif self.total_files and self.files_done:
+                fraction = float(self.files_done) / self.total_files
+            else:
+                return line
+            eta = elapsed / fraction - elapsed if fraction < 1 else 0
+            return line + ', %.0f%%, ETA %s' % (
+                min(fraction, 1) * 100,
+                time.strftime('%H:%M:%S', time.gmtime(eta)))
+
+    def write(self, path):
+        """Write the JSON report to path, or to stderr if path is '-'."""
+        text = json.dumps(self.report(), indent=2, sort_keys=True) + '\n'
+        if path == '-':
+            sys.stderr.write(text)
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+
+class ProgressReporter(threading.Thread):
+    """A thread printing a progress line every interval seconds."""
+
+    def __init__(self, stats, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            info('Progress: ' + self.stats.progress_line())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+STATS = Stats()
+
+class Throttle(object):
+    """Limit the average rate at which bytes are read, across threads."""
+
+    def __init__(self, rate):
+        # bytes per second
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.start = None
+        self.total = 0
+
+    def consume(self, nbytes):
+        """Account for nbytes read, sleeping if reading ahead of the rate."""
+        with self.lock:
+            now = time.time()
+            if self.start is None:
+                self.start = now
+            self.total += nbytes
+            delay = self.start + self.total / self.rate - now
+        if delay > 0:
+            time.sleep(delay)
+
 class Cache(object):
+    """
+    A checksum cache stored as an append-only journal of hashstat lines.
+
+    Each save appends only the entries that changed, so a key may appear on
+    several lines and the last one wins. Loading only indexes the byte offset
+    of each key's current line; entries are parsed when they are looked up.
+    The journal is compacted once superseded lines outnumber live ones.
+
+    Cache lines also record each file's device and inode numbers, so an
+    entry can be found again by inode after the file has been renamed.
+
+    To keep caches of millions of files small in memory, the index holds
+    each key's offset, size and mtime in arrays rather than as objects, and
+    changed entries are kept as their cache lines until saved. Entry objects
+    are only created when a key is looked up.
+
+    Several processes may use the same cache at once. No lock is held while
+    hashing: a save takes a brief exclusive lock, first indexes any lines
+    other processes appended since this one last read the file, and then
+    appends its own. Compaction writes a new file and renames it into place,
+    so readers holding the old file still see a consistent journal, and
+    writers notice the rename and reopen the new file before appending.
+    """
+
+    # don't bother compacting journals with fewer superseded lines than this
+    COMPACT_MIN_STALE = 1024
+
     def __init__(self, filename, readonly=True):
         self.filename = filename
         self.readonly = readonly
@@ -50,47 +314,203 @@ class Cache(object):
             fdno = os.open(filename, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
             os.close(fdno)
 
+        self.lock = threading.Lock()
+        self.changed = {}
         self.load()
 
     def open(self):
         # open cache file
         if self.readonly:
-            fd = open(self.filename, 'r')
+            self.fd = open(self.filename, 'r')
         else:
-            fd = open(self.filename, 'r+')
+            self.fd = open(self.filename, 'r+')
+
+    def lock_file(self):
+        """
+        Take an exclusive lock on the cache file, waiting for other writers.
+        If another process compacted the cache in the meantime, reopen the
+        new file and index it from the start.
+        """
+        while True:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            current = os.stat(self.filename)
+            opened = os.fstat(self.fd.fileno())
+            if (current.st_dev, current.st_ino) == (opened.st_dev,
+                                                    opened.st_ino):
+                return
+
+            info('Cache %r was replaced; reopening' % self.filename)
+            self.fd.close()
+            self.open()
+            self.reset_index()
+
+    def unlock_file(self):
+        self.fd.flush()
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def reset_index(self):
+        # row of each key in the columns below
+        self.rows = {}
+        # offset of each row's current line, its size, its mtime in
+        # nanoseconds (-1 if only recorded to the millisecond), its inode
+        # number and when it was last verified (0 if not recorded)
+        self.offsets = array.array('l')
+        self.sizes = array.array('l')
+        self.mtimes = array.array('l')
+        self.inos = array.array('L')
+        self.verified = array.array('l')
+        # the most recent key for each inode number, built when first needed
+        self.inodes = None
+        self.lines = 0
+        self.end = 0
 
-        # lock it for reading or writing depending on self.readonly
+    def index_line(self, line, offset):
+        """Index line, found at offset, as the current line for its key."""
+        _, mtime, size, key = split_line(line)
         try:
-            if self.readonly:
-                fcntl.lockf(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
-            else:
-                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError, e:
-            if e.errno == errno.EAGAIN:
-                raise HasherError('Failed to lock %r' % self.filename)
-            else:
-                raise
+            size, _, ino, verified = parse_size(size)
+            mtime = parse_mtime_ns(mtime)
+        except ValueError:
+            raise ParseError('Cannot parse hashstat line: %r' % line)
+
+        row = self.rows.get(key)
+        if row is None:
+            self.rows[key] = len(self.offsets)
+            self.offsets.append(offset)
+            self.sizes.append(size)
+            self.mtimes.append(mtime)
+            self.inos.append(ino or 0)
+            self.verified.append(verified or 0)
+        else:
+            self.offsets[row] = offset
+            self.sizes[row] = size
+            self.mtimes[row] = mtime
+            self.inos[row] = ino or 0
+            self.verified[row] = verified or 0
+        if ino and self.inodes is not None:
+            self.inodes[ino] = key
 
-        self.fd = fd
-        self.data = {}
+    def index_inodes(self):
+        """Build the inode index, preferring each inode's latest line."""
+        self.inodes = {}
+        for key, row in self.rows.iteritems():
+            ino = self.inos[row]
+            if not ino:
+                continue
+            other = self.inodes.get(ino)
+            if (other is None or
+                    self.offsets[self.rows[other]] < self.offsets[row]):
+                self.inodes[ino] = key
+        for key, line in self.changed.iteritems():
+            ino = parse_size(split_line(line)[2])[2]
+            if ino is not None:
+                self.inodes[ino] = key
 
     def load(self):
+        with STATS.timer('load'):
+            return self.load_entries()
+
+    def load_entries(self):
         self.open()
+        self.reset_index()
+        self.read_index()
 
-        for line in self.fd:
-            self.add_string(line)
+        info('Loaded %d entries from cache' % len(self.rows))
+        return len(self.rows)
 
-        info('Loaded %d entries from cache' % len(self.data))
-        return len(self.data)
+    def read_index(self):
+        """
+        Index the complete lines from self.end to the end of the file, and
+        return the incomplete line left at the end, if any. That is either
+        being appended by another process or, if we hold the lock, a torn
+        write from an interrupted save.
+        """
+        self.fd.seek(self.end)
+        for line in iter(self.fd.readline, ''):
+            if not line.endswith('\n'):
+                return line
+            self.index_line(line, self.end)
+            self.lines += 1
+            self.end += len(line)
+        return ''
 
     def save(self):
+        with STATS.timer('save'):
+            with self.lock:
+                self.lock_file()
+                try:
+                    self.save_entries()
+                finally:
+                    self.unlock_file()
+
+    def save_entries(self):
         info('Saving cache to ' + repr(self.filename))
-        self.fd.seek(0)
-        self.fd.truncate(0)
-        for _, entry in sorted(self.data.iteritems()):
-            self.fd.write(entry.to_line() + '\n')
+
+        # merge in what other processes saved since we last read the file
+        lines = self.lines
+        torn = self.read_index()
+        if self.lines > lines:
+            info('Merged %d cache entries saved by other processes'
+                 % (self.lines - lines))
+        if torn:
+            warn('Discarding truncated cache line %r' % torn)
+
+        self.fd.seek(self.end)
+        self.fd.truncate(self.end)
+        for key, line in sorted(self.changed.iteritems()):
+            self.fd.write(line)
+            self.index_line(line, self.end)
+            self.end += len(line)
+            self.lines += 1
         self.fd.flush()
-        info('Saved %d cache entries' % len(self.data))
+        info('Saved %d changed cache entries' % len(self.changed))
+        self.changed.clear()
+
+        stale = self.lines - len(self.rows)
+        if stale >= self.COMPACT_MIN_STALE and stale > len(self.rows):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal keeping only the current line for each key, then
+        atomically replace the cache file with it. Must be called with the
+        file locked; the new file is locked before it replaces the old one.
+        """
+        info('Compacting cache %r' % self.filename)
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        tmp = open(tmpname, 'w+')
+        fcntl.lockf(tmp, fcntl.LOCK_EX)
+        os.chmod(tmpname, os.fstat(self.fd.fileno()).st_mode & 07777)
+
+        offsets = array.array('l', self.offsets)
+        offset = 0
+        self.fd.seek(0)
+        for line in iter(self.fd.readline, ''):
+            row = self.rows.get(parse_filename(line))
+            if row is not None and self.offsets[row] == offset:
+                offsets[row] = tmp.tell()
+                tmp.write(line)
+            offset += len(line)
+            if offset >= self.end:
+                break
+
+        tmp.flush()
+        os.fsync(tmp.fileno())
+        os.rename(tmpname, self.filename)
+
+        self.unlock_file()
+        self.fd.close()
+        self.fd = tmp
+        self.offsets = offsets
+        self.lines = len(self.rows)
+        self.end = tmp.tell()
+        info('Compacted cache to %d entries' % self.lines)
+
+    def read_entry(self, key):
+        with self.lock:
+            self.fd.seek(self.offsets[self.rows[key]])
+            line = self.fd.readline()
+        return Entry(string=line)
 
     def add_string(self, line):
         entry = Entry(string=line)
@@ -100,16 +520,148 @@ class Cache(object):
         return self.add(entry.filename, entry)
 
     def add(self, key, value):
-        if self.data.get(key):
+        if key in self:
             warn('%r already found in cache' % key)
-        self.data[key] = value
-        return value
+        return self.update_entry(value)
+
+    def update_entry(self, entry):
+        """Add or replace the cache entry for entry.filename."""
+        line = entry.to_line(inode=True) + '\n'
+        with self.lock:
+            self.changed[entry.filename] = line
+            if entry.ino is not None and self.inodes is not None:
+                self.inodes[entry.ino] = entry.filename
+        return entry
+
+    def find_inode(self, stats):
+        """
+        Return the cached entry for another name of the file described by
+        the stat result stats, or None if there is no such entry or the file
+        has been modified since it was hashed.
+        """
+        with self.lock:
+            if self.inodes is None:
+                self.index_inodes()
+            key = self.inodes.get(stats.st_ino)
+        if key is None:
+            return None
+        entry = self.get(key)
+        if not entry.same_inode(stats):
+            return None
+        return entry
+
+    def least_verified(self, count=None, nbytes=None, accept=None):
+        """
+        Return the keys of the count entries, or of the entries totalling at
+        least nbytes, that were verified longest ago, oldest first. Entries
+        never verified come first. Keys for which accept(key) is False are
+        passed over, and don't count towards the limits.
+        """
+        keys = []
+        total = 0
+        for key in sorted(self.rows,
+                          key=lambda key: self.verified[self.rows[key]]):
+            if count is not None and len(keys) >= count:
+                break
+            if nbytes is not None and total >= nbytes:
+                break
+            if accept is not None and not accept(key):
+                continue
+            keys.append(key)
+            total += self.sizes[self.rows[key]]
+        return keys
+
+    def may_match(self, key, stats):
+        """
+        Return False if the indexed size or mtime of key show that the file
+        described by stats has changed since it was cached. This doesn't read
+        the cache line, so a True result still needs checking.
+        """
+        row = self.rows.get(key)
+        if key in self.changed or row is None:
+            return True
+        return (self.sizes[row] == stats.st_size and
+                self.mtimes[row] in (-1, mtime_ns(stats)))
 
     def get(self, key):
-        return self.data[key]
+        if key in self.changed:
+            return Entry(string=self.changed[key])
+        return self.read_entry(key)
 
     def __contains__(self, key):
-        return key in self.data
+        return key in self.changed or key in self.rows
+
+    def keys(self):
+        """Return the sorted names of all cached files."""
+        return sorted(set(self.rows) | set(self.changed))
+
+class InodeMemo(object):
+    """
+    Call a function at most once per key, even from several threads. This
+    is used to hash each hardlinked inode only once per run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def get(self, key, func):
+        """
+        Return func(), or the result of the first call made for key. A
+        HasherError raised by that call is raised again for every caller.
+        """
+        with self.lock:
+            slot = self.slots.get(key)
+            first = slot is None
+            if first:
+                slot = self.slots[key] = {'done': threading.Event()}
+
+        if first:
+            try:
+                slot['result'] = func()
+            except HasherError, e:
+                slot['error'] = e
+            finally:
+                slot['done'].set()
+        else:
+            slot['done'].wait()
+
+        if 'error' in slot:
+            raise slot['error']
+        return slot['result']
+
+def parallel_map(func, items, jobs=1):
+    """
+    Yield (item, result, error) for each of items in order, where result is
+    func(item) or error is the HasherError it raised.
+
+    With jobs > 1, func is run in a pool of that many threads. Hashing and
+    file reads release the GIL, so threads are enough to keep several cores
+    and disks busy, while the results are still consumed in input order by
+    the calling thread.
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except HasherError, e:
+            return item, None, e
+
+    if jobs <= 1:
+        for result in itertools.imap(call, items):
+            yield result
+        return
+
+    # The pool iterates over items in its own thread, where an exception
+    # (such as ParseError from a lazily parsed list) is silently lost, so
+    # consume them here first.
+    items = list(items)
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap(call, items):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
 
 class CreateRunner(object):
     def __init__(self, filenames, options):
@@ -120,73 +672,603 @@ class CreateRunner(object):
 
         self.filenames = filenames
         self.opts = options
+        self.hardlinks = InodeMemo()
+
+        self.watched, self.gone = [], set()
+        if self.cache and getattr(options, 'trust_watch', False):
+            self.watched, self.gone = watched_dirs(self.cache.filename)
+            if self.watched:
+                info('Trusting cached entries under %s, watched by a'
+                     ' running --watch' % ', '.join(map(repr, self.watched)))
 
     def run(self):
         self.modified = False
+        self.walk_failed = False
         failures = False
 
-        # hash each file
+        if not getattr(self.opts, 'recursive', False):
+            STATS.expect(len(self.filenames))
+
+        # hash each file, updating the cache only from this thread
         try:
-            for name in self.filenames:
-                try:
-                    print self.hash_file(name)
-                except FailedOpen, e:
-                    sys.stderr.write(BASENAME + ': ' + name + ': ' + e.message
-                                     + '\n')
+            for target, result, error in parallel_map(self.lookup_target,
+                                                      self.targets(),
+                                                      self.jobs()):
+                name = target[0]
+                if error:
+                    sys.stderr.write(BASENAME + ': ' + name + ': ' +
+                                     error.message + '\n')
                     failures = True
+                    continue
+
+                STATS.add_done()
+                entry, changed = result
+                if changed and self.cache:
+                    self.cache.update_entry(entry)
+                    self.modified = True
+                print entry.to_line()
         finally:
             # always save the cache, even when bailing out
             if self.modified:
                 self.cache.save()
 
-        return 1 if failures else 0
+        return 1 if failures or self.walk_failed else 0
+
+    def targets(self):
+        """
+        Yield (filename, direntry) for each file to hash. direntry is None
+        unless the file was found by walking a directory with --recursive.
+        """
+        for name in self.filenames:
+            if getattr(self.opts, 'recursive', False):
+                for target in walk_files(name, self.opts.includes,
+                                         self.opts.excludes,
+                                         onerror=self.walk_error):
+                    yield target
+            else:
+                yield name, None
+
+    def walk_error(self, error):
+        sys.stderr.write(BASENAME + ': ' + error.filename + ': ' +
+                         error.strerror + '\n')
+        self.walk_failed = True
+
+    def jobs(self):
+        return getattr(self.opts, 'jobs', None) or 1
+
+    def algorithm(self):
+        return getattr(self.opts, 'algorithm', None)
+
+    def lookup_target(self, target):
+        return self.lookup(*target)
+
+    def lookup(self, filename, direntry=None):
+        """
+        Return (entry, changed) for filename, hashing the file only if it is
+        not cached or its mtime or size have changed. The cache itself is
+        not modified, so this is safe to call from worker threads.
+
+        The file is stat()ed only once, or not at all if direntry already
+        holds its stat result. A file not cached under its own name reuses
+        the digest cached for the same unmodified inode under another name,
+        and files with several hard links are hashed only once per run.
+        """
+        algorithm = self.algorithm()
+        if self.watched and filename in self.cache and \
+                self.is_watched(filename):
+            entry = self.cache.get(filename)
+            requested = parse_algorithms(algorithm) if algorithm else []
+            if set(requested) <= set(entry.algorithms):
+                STATS.add_hit()
+                return entry, False
+
+        stats = self.stat_file(filename, direntry)
+
+        if self.cache and filename in self.cache:
+            entry = self.cache.get(filename)
+            requested = parse_algorithms(algorithm) if algorithm else []
+            missing = [a for a in requested if a not in entry.algorithms]
+            algorithm = ','.join(entry.algorithms + missing)
+
+            if missing:
+                # hash again to add digests missing from the cached entry
+                info('adding %s digest for %r' % (','.join(missing),
+                                                  filename))
+            elif not entry.needs_refresh(stats):
+                STATS.add_hit()
+                if entry.ino is None:
+                    # record the inode details missing from older caches
+                    return entry.copy(filename, stats), True
+                return entry, False
+            else:
+                info('refreshing %r' % filename)
+        elif self.cache:
+            entry = self.cache.find_inode(stats)
+            requested = parse_algorithms(algorithm or 'md5')
+            if entry and set(requested) <= set(entry.algorithms):
+                info('reusing digest of %r for %r' % (entry.filename,
+                                                      filename))
+                STATS.add_hit()
+                return entry.copy(filename, stats), True
+
+        return self.hash_inode(filename, stats, algorithm), True
+
+    def is_watched(self, filename):
+        """
+        Return True if filename is under a directory being watched, and
+        neither it nor a directory above it has been deleted or moved away.
+        """
+        path = os.path.abspath(filename)
+        if not any(path.startswith(top.rstrip('/') + '/')
+                   for top in self.watched):
+            return False
+        while path != '/':
+            if path in self.gone:
+                return False
+            path = os.path.dirname(path)
+        return True
+
+    def stat_file(self, filename, direntry=None):
+        """Return the stat result for filename, raising FailedOpen."""
+        try:
+            with STATS.timer('stat'):
+                if direntry is None:
+                    return os.stat(filename)
+                return direntry.stat()
+        except OSError, e:
+            raise FailedOpen(e.strerror)
+
+    def hash_inode(self, filename, stats, algorithm):
+        """Hash filename, or reuse the digest of a hard link to it."""
+        if stats.st_nlink < 2:
+            return Entry(filename=filename, algorithm=algorithm, stats=stats)
+
+        key = (stats.st_dev, stats.st_ino, mtime_ns(stats), stats.st_size,
+               algorithm)
+        entry = self.hardlinks.get(key, lambda: Entry(filename=filename,
+                                                      algorithm=algorithm,
+                                                      stats=stats))
+        if entry.filename != filename:
+            info('reusing digest of hard link %r for %r' % (entry.filename,
+                                                            filename))
+            STATS.add_hit()
+            entry = entry.copy(filename, stats)
+        return entry
 
     def hash_file(self, filename):
-        if hasattr(self.opts, 'algorithm'):
-            algorithm = self.opts.algorithm
-        else:
-            algorithm = None
+        entry, changed = self.lookup(filename)
+        if changed and self.cache:
+            self.cache.update_entry(entry)
+            self.modified = True
+
+        return entry.to_line()
+
+class WatchRunner(CreateRunner):
+    """
+    Keep the cache up to date with changes under the FILE directories, as
+    reported by inotifywait (from inotify-tools). Changed files are rehashed
+    once no more writes to them have been seen for --debounce seconds, and
+    their new entries are printed and saved.
+
+    While running, the watched directories are recorded in PATH.watch, which
+    stays locked so that runs with --trust-watch can tell the watch is live.
+    They are only recorded once the files changed before the watch started
+    have been caught up with. Paths deleted or moved away are recorded there
+    too, as their entries remain in the cache.
+    """
+
+    def run(self):
+        self.modified = False
+        self.walk_failed = False
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        self.registration = registration = self.register()
+        if registration is None:
+            return 1
+        self.registration_lock = threading.Lock()
+
+        try:
+            self.inotify = subprocess.Popen(
+                ['inotifywait', '-mr', '--format', '%e %w%f',
+                 '-e', 'close_write', '-e', 'moved_to',
+                 '-e', 'delete', '-e', 'moved_from'] + self.filenames,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            sys.stderr.write(BASENAME + ': inotifywait: ' + e.strerror +
+                             ' (part of inotify-tools)\n')
+            os.unlink(registration.name)
+            registration.close()
+            return 3
+
+        # exit through the finally below on SIGTERM, too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            if not self.wait_for_watches():
+                return 1
+            for func in self.read_events, self.forward_errors:
+                thread = threading.Thread(target=func)
+                thread.daemon = True
+                thread.start()
+
+            # catch up with whatever changed while nothing was watching,
+            # before --trust-watch runs may rely on the cache
+            self.update(self.targets())
+            self.record_gone(key for key in self.cache.keys()
+                             if self.under_watch(key) and
+                                not os.path.lexists(key))
+            with self.registration_lock:
+                for name in self.filenames:
+                    registration.write(os.path.abspath(name) + '\n')
+                registration.flush()
+
+            while self.inotify.poll() is None:
+                time.sleep(max(self.opts.debounce / 2.0, 0.1))
+                self.update(self.settled())
+            return self.inotify.returncode
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            if self.inotify.poll() is None:
+                self.inotify.terminate()
+                self.inotify.wait()
+            os.unlink(registration.name)
+            registration.close()
+
+    def register(self):
+        """
+        Lock and empty PATH.watch, returning the open file, or None if
+        another watch is already running on the same cache.
+        """
+        f = open(self.cache.filename + WATCH_SUFFIX, 'a+')
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            sys.stderr.write(BASENAME + ': ' + self.cache.filename +
+                             ': already being watched\n')
+            f.close()
+            return None
+        f.truncate(0)
+        f.flush()
+        return f
+
+    def under_watch(self, path):
+        path = os.path.abspath(path)
+        return any(path.startswith(os.path.abspath(top).rstrip('/') + '/')
+                   for top in self.filenames)
+
+    def record_gone(self, paths):
+        """Record in PATH.watch that paths no longer exist."""
+        with self.registration_lock:
+            for path in paths:
+                self.registration.write('-' + os.path.abspath(path) + '\n')
+            self.registration.flush()
+
+    def wait_for_watches(self):
+        """Wait until inotifywait reports that its watches are set up."""
+        for line in iter(self.inotify.stderr.readline, ''):
+            if line.startswith('Watches established'):
+                return True
+            if not line.startswith('Setting up watches'):
+                sys.stderr.write('inotifywait: ' + line)
+        return False
+
+    def forward_errors(self):
+        for line in iter(self.inotify.stderr.readline, ''):
+            sys.stderr.write('inotifywait: ' + line)
+
+    def read_events(self):
+        """
+        Record the time of the latest event for each changed path, and the
+        paths deleted or moved away.
+        """
+        for line in iter(self.inotify.stdout.readline, ''):
+            events, path = line.rstrip('\n').split(' ', 1)
+            events = events.split(',')
+            if 'DELETE' in events or 'MOVED_FROM' in events:
+                self.record_gone([path])
+                continue
+            with self.pending_lock:
+                self.pending[path] = time.time()
 
-        if self.cache:
+    def settled(self):
+        """
+        Yield (filename, direntry) for the files changed, or under the
+        directories moved in, with no events for the last --debounce
+        seconds.
+        """
+        cutoff = time.time() - self.opts.debounce
+        with self.pending_lock:
+            ready = sorted(path for path, when in self.pending.iteritems()
+                           if when <= cutoff)
+            for path in ready:
+                del self.pending[path]
+
+        own = os.path.abspath(self.cache.filename)
+        for path in ready:
+            if os.path.abspath(path) == own or \
+                    os.path.abspath(path).startswith(own + '.'):
+                # the cache itself, its .watch file or a compaction
+                continue
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError:
+                # already gone again, like most temporary files
+                continue
+            if not (stat.S_ISREG(mode) or stat.S_ISDIR(mode)):
+                continue
+            if self.excluded(path, stat.S_ISDIR(mode)):
+                continue
+            for target in walk_files(path, self.opts.includes,
+                                     self.opts.excludes,
+                                     onerror=self.walk_error):
+                yield target
+
+    def excluded(self, path, isdir):
+        """Return True if walking the watched directories would skip path."""
+        tops = [top for top in self.filenames
+                if path.startswith(top.rstrip('/') + '/')]
+        if tops:
+            path = path[len(max(tops, key=len).rstrip('/')) + 1:]
+        names = path.split('/')
+
+        for pattern in self.opts.excludes or []:
+            if any(fnmatch.fnmatch(name, pattern) for name in names):
+                return True
+        if not isdir and self.opts.includes:
+            return not any(fnmatch.fnmatch(names[-1], pattern)
+                           for pattern in self.opts.includes)
+        return False
+
+    def update(self, targets):
+        """Rehash targets as needed, printing and saving changed entries."""
+        modified = False
+        for target, result, error in parallel_map(self.lookup_target,
+                                                  targets, self.jobs()):
+            if error:
+                sys.stderr.write(BASENAME + ': ' + target[0] + ': ' +
+                                 error.message + '\n')
+                continue
+            STATS.add_done()
+            entry, changed = result
+            if changed:
+                self.cache.update_entry(entry)
+                modified = True
+                print entry.to_line()
+                sys.stdout.flush()
+        if modified:
+            self.cache.save()
+
+class DuplicatesRunner(CreateRunner):
+    """
+    Print groups of files with identical contents. Only files whose size
+    matches another file's are considered, cached digests are used where
+    the file is unchanged, and the remaining candidates are first compared
+    by a hash of their head and tail before being hashed in full.
+    """
+
+    # bytes hashed from each end of a file for the partial comparison
+    PARTIAL_SIZE = 64 * 1024
+
+    def run(self):
+        self.modified = False
+        self.walk_failed = False
+        self.failures = False
+
+        if not self.filenames and self.cache:
+            # with no FILEs, look for duplicates among all cached files
+            self.filenames = self.cache.keys()
+            self.opts.recursive = False
+
+        try:
+            groups = self.find_duplicates()
+        finally:
+            if self.modified:
+                self.cache.save()
+
+        for size, digest, filenames in groups:
+            print json.dumps({'size': size, 'algorithm': self.compared(),
+                              'digest': digest, 'files': filenames},
+                             sort_keys=True)
+
+        return 1 if self.failures or self.walk_failed else 0
+
+    def compared(self):
+        """Return the algorithm whose digests are compared."""
+        return parse_algorithms(self.algorithm() or 'md5')[0]
+
+    def failed(self, filename, error):
+        sys.stderr.write(BASENAME + ': ' + filename + ': ' +
+                         error.message + '\n')
+        self.failures = True
+
+    def find_duplicates(self):
+        """Return a sorted list of (size, digest, filenames) groups."""
+        by_size = {}
+        seen = set()
+        for target, stats, error in parallel_map(self.stat_target,
+                                                 self.targets(), self.jobs()):
+            if error:
+                self.failed(target[0], error)
+                continue
+            # extra hard links share their data, so they aren't duplicates
+            if stats.st_size == 0 or (stats.st_dev, stats.st_ino) in seen:
+                continue
+            seen.add((stats.st_dev, stats.st_ino))
+            by_size.setdefault(stats.st_size, []).append((target[0], stats))
+
+        candidates = [c for group in by_size.itervalues() if len(group) > 1
+                      for c in group]
+        digests = self.cached_digests(candidates)
+
+        # compare heads and tails in size groups that need any hashing
+        partial = {}
+        needed = [(filename, stats) for size, group in by_size.iteritems()
+                  if len(group) > 1 and
+                     any(filename not in digests for filename, _ in group)
+                  for filename, stats in group]
+        for target, digest, error in parallel_map(self.partial_digest,
+                                                  needed, self.jobs()):
+            if error:
+                self.failed(target[0], error)
+                continue
+            partial[target[0]] = digest
+
+        # hash in full only the files whose partial digest isn't unique
+        counts = {}
+        for filename, stats in needed:
+            if filename in partial:
+                key = (stats.st_size, partial[filename])
+                counts[key] = counts.get(key, 0) + 1
+        unhashed = [(filename, stats) for filename, stats in needed
+                    if filename not in digests and filename in partial and
+                       counts[(stats.st_size, partial[filename])] > 1]
+        for target, entry, error in parallel_map(self.hash_target, unhashed,
+                                                 self.jobs()):
+            if error:
+                self.failed(target[0], error)
+                continue
+            STATS.add_done()
+            if self.cache:
+                self.cache.update_entry(entry)
+                self.modified = True
+            digests[target[0]] = entry.digest_of(self.compared())
+
+        groups = {}
+        for filename, stats in candidates:
+            if filename in digests:
+                key = (stats.st_size, digests[filename])
+                groups.setdefault(key, []).append(filename)
+        return sorted(((size, digest, sorted(filenames))
+                       for (size, digest), filenames in groups.iteritems()
+                       if len(filenames) > 1),
+                      key=lambda group: (-group[0], group[2]))
+
+    def stat_target(self, target):
+        return self.stat_file(*target)
+
+    def cached_digests(self, candidates):
+        """
+        Return a dict of the digests cached for unchanged candidates, which
+        is a list of (filename, stats).
+        """
+        digests = {}
+        if not self.cache:
+            return digests
+
+        algorithm = self.compared()
+        for filename, stats in candidates:
             if filename in self.cache:
+                if not self.cache.may_match(filename, stats):
+                    continue
                 entry = self.cache.get(filename)
-                if entry.needs_refresh():
-                    info('refreshing %r' % filename)
-                    entry.refresh_data()
-                    self.modified = True
+                if entry.needs_refresh(stats):
+                    continue
             else:
-                entry = Entry(filename=filename, algorithm=algorithm)
-                self.cache.add_entry(entry)
-                self.modified = True
-        else:
-            entry = Entry(filename=filename)
+                entry = self.cache.find_inode(stats)
+                if entry is None:
+                    continue
+            digest = entry.digest_of(algorithm)
+            if digest is not None:
+                STATS.add_hit()
+                digests[filename] = digest
+        return digests
 
-        return entry.to_line()
+    def partial_digest(self, target):
+        """Return the MD5 digest of the head and tail of a file."""
+        filename, stats = target
+        md5 = hashlib.md5()
+        try:
+            update_digest([md5], filename, length=self.PARTIAL_SIZE)
+            if stats.st_size > self.PARTIAL_SIZE:
+                tail = max(stats.st_size - self.PARTIAL_SIZE,
+                           self.PARTIAL_SIZE)
+                update_digest([md5], filename, offset=tail,
+                              length=self.PARTIAL_SIZE)
+        except (IOError, OSError), e:
+            raise FailedOpen(e.strerror)
+        return md5.hexdigest()
+
+    def hash_target(self, target):
+        """
+        Hash a file in full, keeping the algorithms of its cached entry so
+        that updating the cache loses none of its digests.
+        """
+        filename, stats = target
+        algorithms = parse_algorithms(self.algorithm() or 'md5')
+        if self.cache and filename in self.cache:
+            cached = self.cache.get(filename).algorithms
+            algorithms = cached + [a for a in algorithms if a not in cached]
+        return self.hash_inode(filename, stats, ','.join(algorithms))
 
 class CheckRunner(object):
     def __init__(self, filenames, options):
         self.filenames = filenames
         self.opts = options
 
+    def verify_entry(self, entry):
+        """Verify entry, returning the VerificationError raised, if any."""
+        try:
+            entry.verify(stat=self.opts.do_stat, digest=self.opts.do_digest)
+        except VerificationError, e:
+            return e
+        return None
+
     def check_file(self, filename):
         f = open(filename, 'r')
-        for line in f:
-            entry = Entry(string=line)
-            try:
-                entry.verify(stat=self.opts.do_stat,
-                             digest=self.opts.do_digest)
-            except FailedOpen:
-                print entry.filename + ': FAILED open or read'
-                self.failed_open += 1
-            except (MtimeMismatch, SizeMismatch):
-                print entry.filename + ': FAILED mtime/size check'
-                self.failed_stat += 1
-            except DigestMismatch:
-                print entry.filename + ': FAILED'
-                self.failed += 1
+        entries = (Entry(string=line) for line in f)
+        jobs = getattr(self.opts, 'jobs', None) or 1
+        order = getattr(self.opts, 'order', None) or 'listed'
+
+        if getattr(self.opts, 'progress', None):
+            # read the whole list up front to know the total for the ETA
+            entries = list(entries)
+            STATS.expect(len(entries),
+                         sum(e.size for e in entries)
+                         if self.opts.do_digest else None)
+
+        if order == 'listed':
+            for entry, error, _ in parallel_map(self.verify_entry, entries,
+                                                jobs):
+                self.report(entry, error)
+            return
+
+        # Read the files in order of their location on disk, but buffer the
+        # results so that they are still reported in listed order.
+        key_func = inode_key if order == 'inode' else extent_key
+        keyed = [(key, index, entry) for index, (entry, key, _) in
+                 enumerate(parallel_map(lambda e: key_func(e.filename),
+                                        entries, jobs))]
+        keyed.sort()
+
+        results = {}
+        next_index = 0
+        for (_, index, entry), error, _ in parallel_map(
+                lambda item: self.verify_entry(item[2]), keyed, jobs):
+            results[index] = entry, error
+            while next_index in results:
+                self.report(*results.pop(next_index))
+                next_index += 1
+
+    def report(self, entry, error):
+        STATS.add_done()
+        if isinstance(error, FailedOpen):
+            print entry.filename + ': FAILED open or read'
+            self.failed_open += 1
+        elif isinstance(error, (MtimeMismatch, SizeMismatch)):
+            print entry.filename + ': FAILED mtime/size check'
+            self.failed_stat += 1
+        elif isinstance(error, DigestMismatch):
+            ranges = getattr(error, 'ranges', None)
+            if ranges:
+                print entry.filename + ': FAILED in bytes ' + ', '.join(
+                    '%d-%d' % r for r in ranges)
             else:
-                if not self.opts.quiet:
-                    print entry.filename + ': OK'
+                print entry.filename + ': FAILED'
+            self.failed += 1
+        else:
+            if not self.opts.quiet:
+                print entry.filename + ': OK'
 
     def run(self):
         self.failed_open = 0
@@ -194,7 +1276,10 @@ class CheckRunner(object):
         self.failed = 0
         for name in self.filenames:
             self.check_file(name)
+        return self.summarize()
 
+    def summarize(self):
+        """Warn about any failures and return the exit status."""
         if self.failed_open:
             warn('%d listed file%s could not be read' %
                  (self.failed_open, '' if self.failed_open == 1 else 's'))
@@ -210,25 +1295,420 @@ class CheckRunner(object):
         else:
             return 0
 
+class ScrubRunner(CheckRunner):
+    """
+    Verify the cached files that were verified longest ago, reading at most
+    --scrub bytes or percent of the entries per run, so that repeated runs
+    cover every file without saturating the disks. Files whose mtime or
+    size changed since they were cached, or that are missing, are reported
+    but neither read nor counted, so they don't hold up the others.
+    """
+
+    def __init__(self, filenames, options):
+        CheckRunner.__init__(self, filenames, options)
+        self.cache = Cache(options.cache_file, readonly=False)
+
+    def run(self):
+        self.failed_open = 0
+        self.failed_stat = 0
+        self.failed = 0
+
+        count, nbytes = parse_scrub_amount(self.opts.scrub)
+        if count is not None:
+            count = int(math.ceil(len(self.cache.rows) * count / 100.0))
+        stale = []
+
+        def unchanged(key):
+            entry = self.cache.get(key)
+            try:
+                entry.verify_stat()
+            except VerificationError, e:
+                stale.append((entry, e))
+                return False
+            return True
+
+        keys = self.cache.least_verified(count=count, nbytes=nbytes,
+                                         accept=unchanged)
+        info('Scrubbing %d of %d cached files' % (len(keys),
+                                                 len(self.cache.rows)))
+        STATS.expect(len(keys) + len(stale))
+        for entry, error in stale:
+            self.report(entry, error)
+
+        modified = False
+        try:
+            for _, result, error in parallel_map(self.verify_key, keys,
+                                                 self.jobs()):
+                if error:
+                    raise error
+                entry, error = result
+                self.report(entry, error)
+                if error is None:
+                    self.cache.update_entry(entry)
+                    modified = True
+        finally:
+            if modified:
+                self.cache.save()
+        return self.summarize()
+
+    def jobs(self):
+        return getattr(self.opts, 'jobs', None) or 1
+
+    def verify_key(self, key):
+        """Verify the cached entry for key, returning (entry, error)."""
+        entry = self.cache.get(key)
+        started = int(time.time())
+        try:
+            stats = os.stat(entry.filename)
+        except OSError:
+            stats = None
+        error = self.verify_entry(entry)
+        if error is None:
+            entry.verified = started
+            if entry.ino is None and stats is not None and \
+                    not entry.needs_refresh(stats):
+                # the verified time is only saved along with the inode
+                # details, which older caches lack
+                entry.set_stats(stats)
+        return entry, error
+
+class ListdirEntry(object):
+    """A minimal os.DirEntry work-alike for when scandir is unavailable."""
+
+    def __init__(self, top, name):
+        self.name = name
+        self.path = os.path.join(top, name)
+        self._lstat = None
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks or not self.is_symlink():
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+def list_dir(top):
+    """Return the DirEntry objects for top, sorted by name."""
+    if scandir is not None:
+        entries = list(scandir(top))
+    else:
+        entries = [ListdirEntry(top, name) for name in os.listdir(top)]
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+def walk_files(top, includes=None, excludes=None, onerror=None):
+    """
+    Yield (path, direntry) for each regular file under the directory top,
+    in sorted depth-first order. Symlinks are not followed.
+
+    Files and directories whose names match one of the excludes glob
+    patterns are skipped, as are files that match none of the includes (if
+    any were given). If top is not a directory it is yielded as is. Errors
+    listing a directory are passed to onerror, as with os.walk().
+    """
+    if not os.path.isdir(top):
+        yield top, None
+        return
+
+    try:
+        entries = list_dir(top)
+    except OSError, e:
+        if onerror is not None:
+            onerror(e)
+        return
+
+    for direntry in entries:
+        name = direntry.name
+        if excludes and any(fnmatch.fnmatch(name, p) for p in excludes):
+            continue
+
+        if direntry.is_dir(follow_symlinks=False):
+            for target in walk_files(direntry.path, includes, excludes,
+                                     onerror):
+                yield target
+        elif direntry.is_file(follow_symlinks=False):
+            if includes and not any(fnmatch.fnmatch(name, p)
+                                    for p in includes):
+                continue
+            yield direntry.path, direntry
+
+def update_digest(hashes, filename, chunk_size=None, offset=0, length=None):
+    """
+    Feed the contents of filename to each of the hash objects in hashes and
+    return the number of bytes read. If length is given, only that many
+    bytes starting at offset are hashed.
+
+    The file is read in binary mode into a single reusable buffer, so no
+    new string is allocated per chunk. (An mmap would save a copy, but a
+    file truncated while being hashed would then kill the process with
+    SIGBUS, where reading just stops early.)
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+
+    total = 0
+    with io.open(filename, 'rb', buffering=0) as f:
+        if offset:
+            f.seek(offset)
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        remaining = length
+        while remaining is None or remaining > 0:
+            if remaining is not None and remaining < chunk_size:
+                count = f.readinto(view[:remaining])
+            else:
+                count = f.readinto(buf)
+            if not count:
+                break
+            if remaining is not None:
+                remaining -= count
+            chunk = view[:count]
+            for h in hashes:
+                h.update(chunk)
+            if DROP_CACHE:
+                drop_cache(f.fileno(), offset + total, count)
+            total += count
+            STATS.add_bytes(count)
+            if THROTTLE:
+                THROTTLE.consume(count)
+
+    return total
+
+def watched_dirs(cache_filename):
+    """
+    Return the directories watched by a running --watch on the cache
+    cache_filename and the set of paths it has seen go, or an empty list
+    and set if there is none.
+    """
+    try:
+        f = open(cache_filename + WATCH_SUFFIX, 'r')
+    except IOError:
+        return [], set()
+    with f:
+        try:
+            fcntl.lockf(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            # still locked by the watching process
+            lines = [line.rstrip('\n') for line in f]
+            return ([line for line in lines if not line.startswith('-')],
+                    set(line[1:] for line in lines if line.startswith('-')))
+        return [], set()
+
+def parse_scrub_amount(amount):
+    """
+    Parse a --scrub amount, either a percentage of entries such as '5%' or
+    a number of bytes with an optional K, M, G or T suffix. Return (percent,
+    nbytes) with None for the one not given. Raises ValueError.
+    """
+    if amount.endswith('%'):
+        percent = float(amount[:-1])
+        if not 0 < percent <= 100:
+            raise ValueError('Scrub percentage must be between 0 and 100')
+        return percent, None
+
+    suffix = amount[-1:].upper()
+    scale = 1
+    if suffix in SIZE_SUFFIXES:
+        amount = amount[:-1]
+        scale = SIZE_SUFFIXES[suffix]
+    nbytes = int(float(amount) * scale)
+    if nbytes < 1:
+        raise ValueError('Scrub size must be at least 1 byte')
+    return None, nbytes
+
+def drop_cache(fd, offset, length):
+    """Advise the kernel to drop a range of the file fd from the page cache."""
+    if posix_fadvise is not None:
+        posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+def tree_digests(filename, algorithms, leaf_size, jobs=1):
+    """
+    Split filename into ranges of leaf_size bytes and hash each range with
+    each of algorithms, reading up to jobs ranges concurrently. Return the
+    number of bytes read, and for each algorithm the list of binary leaf
+    digests in file order.
+    """
+    size = os.stat(filename).st_size
+
+    def hash_leaf(offset):
+        hashes = [hashlib.new(a) for a in algorithms]
+        count = update_digest(hashes, filename, offset=offset,
+                              length=leaf_size)
+        return count, [h.digest() for h in hashes]
+
+    offsets = range(0, size, leaf_size)
+    if jobs > 1 and len(offsets) > 1:
+        pool = ThreadPool(min(jobs, len(offsets)))
+        try:
+            leaves = pool.map(hash_leaf, offsets, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        leaves = map(hash_leaf, offsets)
+
+    return (sum(count for count, _ in leaves),
+            [[leaf[1][i] for leaf in leaves] for i in range(len(algorithms))])
+
+def format_tree_digest(algorithm, leaf_size, leaves):
+    """
+    Format a tree digest as ALGORITHM:LEAF_SIZE:ROOT:LEAF.LEAF..., where the
+    root is the base algorithm's hash of the concatenated binary leaves.
+    """
+    root = hashlib.new(tree_base(algorithm), ''.join(leaves)).hexdigest()
+    return ':'.join([algorithm, str(leaf_size), root,
+                     '.'.join(leaf.encode('hex') for leaf in leaves)])
+
+def parse_tree_digest(string):
+    """
+    Parse a tree digest, returning (algorithm, leaf_size, root, leaves) with
+    the leaves as a list of hex digests. Raises ValueError.
+    """
+    algorithm, leaf_size, root, leaves = string.split(':')
+    parse_algorithms(algorithm)
+    leaf_size = int(leaf_size)
+    if leaf_size < 1:
+        raise ValueError('Invalid leaf size %r' % leaf_size)
+    return algorithm, leaf_size, root, leaves.split('.') if leaves else []
+
+def is_tree(algorithm):
+    return algorithm.endswith(TREE_SUFFIX)
+
+def tree_base(algorithm):
+    return algorithm[:-len(TREE_SUFFIX)]
+
+def inode_key(filename):
+    """Return a sort key placing files in order of device and inode number."""
+    try:
+        stats = os.stat(filename)
+    except OSError:
+        return None, None
+    return stats.st_dev, stats.st_ino
+
+def extent_key(filename):
+    """
+    Return a sort key placing files in order of device and the physical
+    offset of their first extent, as reported by the FIEMAP ioctl. Falls
+    back to the inode number on filesystems without FIEMAP support.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            buf = array.array('B', FIEMAP.pack(0, FIEMAP_MAX_OFFSET, 0, 0, 1,
+                                               0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+            dev = os.fstat(f.fileno()).st_dev
+    except (IOError, OSError):
+        return inode_key(filename)
+
+    fields = FIEMAP.unpack(buf.tostring())
+    mapped_extents, physical = fields[3], fields[7]
+    return dev, physical if mapped_extents else 0
+
+def parse_algorithms(value):
+    """
+    Return the list of algorithm names in the comma-separated string value,
+    raising ValueError for any that are unknown. Each algorithm may also be
+    used as a tree hash by adding the suffix "-tree".
+    """
+    algorithms = value.split(',')
+    for algorithm in algorithms:
+        if is_tree(algorithm):
+            base = tree_base(algorithm)
+        else:
+            base = algorithm
+        if base not in HASH_LENGTHS.values():
+            raise ValueError('Unsupported algorithm %r' % algorithm)
+    return algorithms
+
+def split_line(line):
+    """Split a hashstat line into its digest, mtime, size and name fields."""
+    parts = line.rstrip('\r\n').split(' ', 3)
+    if len(parts) != 4:
+        raise ParseError('Cannot parse hashstat line: %r' % line)
+    return parts
+
+def parse_filename(line):
+    """Return just the filename field of a hashstat line."""
+    return split_line(line)[3]
+
+def parse_size(field):
+    """
+    Parse the size field of a hashstat line, which is either SIZE or, in
+    cache files, SIZE:DEV:INODE or SIZE:DEV:INODE:VERIFIED, where VERIFIED is
+    when the digest was last computed or checked in seconds since the epoch.
+    Return (size, dev, inode, verified), with None for any absent fields.
+    Raises ValueError.
+    """
+    parts = field.split(':')
+    if len(parts) == 4:
+        return tuple(map(int, parts))
+    elif len(parts) == 3:
+        return tuple(map(int, parts)) + (None,)
+    elif len(parts) == 1:
+        return int(parts[0]), None, None, None
+    raise ValueError('Invalid size field %r' % field)
+
+def parse_mtime_ns(field):
+    """
+    Parse the mtime field of a hashstat line into integer nanoseconds, or -1
+    if it only has millisecond precision. Raises ValueError.
+    """
+    seconds, _, fraction = field.partition('.')
+    if len(fraction) != 9:
+        float(field)
+        return -1
+    return int(seconds) * 10**9 + int(fraction)
+
+def mtime_ns(stats):
+    """Return the mtime of the stat result stats in integer nanoseconds."""
+    if getattr(stats, 'st_mtime_ns', None) is not None:
+        return stats.st_mtime_ns
+    return int(round(stats.st_mtime * 10**9))
+
 def warn(message):
     sys.stderr.write('WARNING: ' + message + '\n')
 def info(message):
     sys.stderr.write('Info: ' + message + '\n')
 
 class Entry(object):
+    __slots__ = ('filename', 'digest', 'mtime', 'size', 'algorithms',
+                 'dev', 'ino', 'mtime_ns', 'leaf_size', 'verified')
+
     def __init__(self, filename=None, string=None,
-                 binary=False, algorithm=None):
+                 algorithm=None, stats=None):
         if (filename and string) or (filename is None and string is None):
             raise ValueError('exactly one of filename and string is required')
         if algorithm is None:
             algorithm = 'md5'
 
+        # only known for entries read from a cache or freshly hashed
+        self.dev = self.ino = self.mtime_ns = self.verified = None
+        self.leaf_size = LEAF_SIZE
+
         if string:
             self.parse_string(string)
         elif filename:
             self.filename = filename
-            self.algorithm = algorithm
-            self.refresh_data()
+            self.algorithms = parse_algorithms(algorithm)
+            self.refresh_data(stats)
         else:
             assert(false)
 
@@ -239,65 +1719,158 @@ class Entry(object):
 
         digest, mtime, size, name = parts
         try:
-            mtime = float(mtime)
-            size = int(size)
+            if len(mtime.partition('.')[2]) == 9:
+                # nanosecond mtime, as written to cache files
+                seconds, _, nanoseconds = mtime.partition('.')
+                self.mtime_ns = int(seconds) * 10**9 + int(nanoseconds)
+                mtime = round(self.mtime_ns / 1e9, 3)
+            else:
+                mtime = float(mtime)
+            size, self.dev, self.ino, self.verified = parse_size(size)
         except ValueError:
             raise ParseError('Cannot parse hashstat line: %r' % string)
 
-        try:
-            self.algorithm = HASH_LENGTHS[len(digest)]
-        except KeyError:
-            raise ParseError('Cannot find hash algorithm of length %d for %r'
-                             % (len(digest), line))
+        self.algorithms = []
+        for hexdigest in digest.split(','):
+            if ':' in hexdigest:
+                try:
+                    algorithm, self.leaf_size, _, _ = \
+                        parse_tree_digest(hexdigest)
+                except ValueError:
+                    raise ParseError('Cannot parse tree digest in %r'
+                                     % string)
+                self.algorithms.append(algorithm)
+                continue
+            try:
+                self.algorithms.append(HASH_LENGTHS[len(hexdigest)])
+            except KeyError:
+                raise ParseError('Cannot find hash algorithm of length %d'
+                                 ' for %r' % (len(hexdigest), string))
 
         self.digest = digest
         self.mtime = mtime
         self.size = size
         self.filename = name
 
-    def refresh_data(self):
-        self.mtime, self.size = self.stat()
+    def refresh_data(self, stats=None):
+        self.set_stats(self.stat_result(stats))
+        self.verified = int(time.time())
         self.digest = self.make_digest()
 
-    def stat(self):
-        """Stat a file and return its mtime and size."""
-        try:
-            stats = os.stat(self.filename)
-        except (IOError, OSError), e:
-            raise FailedOpen(e.strerror)
+    def set_stats(self, stats):
+        self.mtime, self.size = self.stat(stats)
+        self.dev, self.ino = stats.st_dev, stats.st_ino
+        self.mtime_ns = mtime_ns(stats)
+
+    def copy(self, filename, stats):
+        """
+        Return a copy of this entry for filename, which has the same
+        contents, with its stat details taken from stats.
+        """
+        entry = copy.copy(self)
+        entry.filename = filename
+        entry.set_stats(stats)
+        return entry
+
+    def stat_result(self, stats=None):
+        """Return stats, or if it is None, the result of stat()ing the file."""
+        if stats is None:
+            try:
+                with STATS.timer('stat'):
+                    stats = os.stat(self.filename)
+            except (IOError, OSError), e:
+                raise FailedOpen(e.strerror)
+        return stats
 
+    def stat(self, stats=None):
+        """
+        Stat a file and return its mtime and size. If stats is given, it is
+        used instead of calling os.stat() again.
+        """
+        stats = self.stat_result(stats)
         return round(stats.st_mtime, 3), stats.st_size
 
-    def make_digest(self, chunk_size=None, binary=False):
-        """"Compute the hash digest of a file."""
-        h = hashlib.new(self.algorithm)
+    def same_inode(self, stats):
+        """
+        Return True if stats describes the inode this entry was hashed from,
+        with the same nanosecond mtime and size.
+        """
+        return (self.ino is not None and
+                (self.dev, self.ino) == (stats.st_dev, stats.st_ino) and
+                self.mtime_ns == mtime_ns(stats) and
+                self.size == stats.st_size)
+
+    @property
+    def algorithm(self):
+        return ','.join(self.algorithms)
 
-        if chunk_size is None:
-            chunk_size = 128 * h.block_size
+    def digest_of(self, algorithm):
+        """Return the digest for algorithm, or None if it wasn't computed."""
+        if algorithm not in self.algorithms:
+            return None
+        return self.digest.split(',')[self.algorithms.index(algorithm)]
 
-        if binary:
-            mode = 'rb'
-        else:
-            mode = 'r'
+    def make_digest(self, chunk_size=None):
+        """"
+        Compute the hash digest of a file, reading it only once even when
+        there are several algorithms. Tree algorithms are computed in a
+        separate pass, hashing ranges of the file concurrently.
+        """
+        flat = [a for a in self.algorithms if not is_tree(a)]
+        trees = [a for a in self.algorithms if is_tree(a)]
+        digests = {}
+        start = time.time()
+        nbytes = 0
 
         try:
-            with open(self.filename, mode) as f:
-                chunk = f.read(chunk_size)
-                while chunk:
-                    h.update(chunk)
-                    chunk = f.read(chunk_size)
-        except IOError, e:
+            if flat:
+                hashes = [hashlib.new(a) for a in flat]
+                nbytes += update_digest(hashes, self.filename, chunk_size)
+                for algorithm, h in zip(flat, hashes):
+                    digests[algorithm] = h.hexdigest()
+            if trees:
+                count, leaf_lists = tree_digests(
+                    self.filename, [tree_base(a) for a in trees],
+                    self.leaf_size, TREE_JOBS)
+                nbytes += count
+                for algorithm, leaves in zip(trees, leaf_lists):
+                    digests[algorithm] = format_tree_digest(
+                        algorithm, self.leaf_size, leaves)
+        except EnvironmentError, e:
             raise FailedOpen(e.strerror)
 
-        return h.hexdigest()
+        STATS.add_digest(self.algorithm, nbytes, time.time() - start)
+        return ','.join(digests[a] for a in self.algorithms)
+
+    def changed_ranges(self, new_digest):
+        """
+        Compare the tree digests in self.digest with those in new_digest and
+        return the list of (first, last) byte ranges whose leaves differ.
+        """
+        changed = set()
+        for old, new in zip(self.digest.split(','), new_digest.split(',')):
+            if ':' not in old or ':' not in new:
+                continue
+            _, leaf_size, _, old_leaves = parse_tree_digest(old)
+            _, _, _, new_leaves = parse_tree_digest(new)
+            for i in range(max(len(old_leaves), len(new_leaves))):
+                if old_leaves[i:i + 1] != new_leaves[i:i + 1]:
+                    changed.add((i * leaf_size, (i + 1) * leaf_size - 1))
+        return sorted(changed)
 
-    def verify_stat(self):
+    def verify_stat(self, stats=None):
         """
         Return True if the file's mtime and size remain the same, else False.
         """
-        mtime, size = self.stat()
+        stats = self.stat_result(stats)
+        mtime, size = self.stat(stats)
+
+        if self.mtime_ns is not None:
+            mtime_changed = mtime_ns(stats) != self.mtime_ns
+        else:
+            mtime_changed = mtime != self.mtime
 
-        if mtime != self.mtime:
+        if mtime_changed:
             raise MtimeMismatch('%r: mtime has changed to %r' %
                                 (self.filename, mtime))
         if size != self.size:
@@ -305,9 +1878,9 @@ class Entry(object):
                                (self.filename, size))
         return True
 
-    def needs_refresh(self):
+    def needs_refresh(self, stats=None):
         try:
-            self.verify_stat()
+            self.verify_stat(stats)
         except (MtimeMismatch, SizeMismatch):
             return True
         else:
@@ -321,8 +1894,10 @@ class Entry(object):
         if new_digest == self.digest:
             return True
         else:
-            raise DigestMismatch('%r: digest has changed to %s' %
-                                 (self.filename, new_digest))
+            e = DigestMismatch('%r: digest has changed to %s' %
+                               (self.filename, new_digest))
+            e.ranges = self.changed_ranges(new_digest)
+            raise e
 
     def verify(self, digest=True, stat=False):
         if not digest and not stat:
@@ -336,30 +1911,98 @@ class Entry(object):
     def to_tuple(self):
         return self.digest, self.mtime, self.size, self.filename
 
-    def to_line(self):
-        return ' '.join([self.digest, '%0.3f' % self.mtime, str(self.size),
-                         self.filename])
+    def to_line(self, inode=False):
+        """
+        Format the entry as a hashstat line. With inode, the line includes
+        the nanosecond mtime, the device and inode numbers and the time the
+        digest was last verified, if known.
+        """
+        if inode and self.ino is not None:
+            seconds, nanoseconds = divmod(self.mtime_ns, 10**9)
+            mtime = '%d.%09d' % (seconds, nanoseconds)
+            size = '%d:%d:%d' % (self.size, self.dev, self.ino)
+            if self.verified is not None:
+                size += ':%d' % self.verified
+        else:
+            mtime = '%0.3f' % self.mtime
+            size = str(self.size)
+        return ' '.join([self.digest, mtime, size, self.filename])
 
 if __name__ == '__main__':
     p = optparse.OptionParser(usage='usage: %prog [options] FILE...' +
                               __doc__.rstrip())
+    # files are always read in binary mode; -b and -t are accepted for
+    # compatibility with md5sum
     p.add_option('-b', '--binary', action='store_true', dest='binary',
-                 help='read in binary mode')
+                 help='ignored; files are always read in binary mode')
     p.add_option('-t', '--text', action='store_false', dest='binary',
-                 help='read in text mode (default)')
+                 help='ignored; files are always read in binary mode')
     p.add_option('-c', '--check', action='store_true', dest='check_mode',
                  help='read checksums from the FILEs and check them')
+    p.add_option('--scrub', dest='scrub', metavar='AMOUNT',
+                 help='verify the files in --file PATH that were verified'
+                      ' longest ago, up to AMOUNT bytes (with an optional'
+                      ' K, M, G or T suffix) or AMOUNT%% of the entries')
+    p.add_option('--max-rate', dest='max_rate', type='float', metavar='MB',
+                 help='with --scrub, read at most MB megabytes per second')
+    p.add_option('--watch', action='store_true', dest='watch',
+                 help='keep --file PATH up to date with changes under the'
+                      ' FILE directories until interrupted, using'
+                      ' inotifywait')
+    p.add_option('--debounce', dest='debounce', type='float', default=2.0,
+                 metavar='SECONDS',
+                 help='with --watch, rehash a file once it has not been'
+                      ' written for SECONDS (default %default)')
+    p.add_option('--trust-watch', action='store_true', dest='trust_watch',
+                 help="don't stat cached files under directories a running"
+                      ' --watch on PATH is watching; their entries may lag'
+                      ' behind writes by the --debounce time')
+    p.add_option('--duplicates', action='store_true', dest='duplicates',
+                 help='print groups of FILEs with identical contents as JSON'
+                      ' lines, or of all files cached in --file PATH if no'
+                      ' FILE is given')
     p.add_option('-f', '--file', dest='cache_file', metavar='PATH',
                  help='cache checksums in PATH,'
-                      ' updating if mtime or size changed')
+                      ' updating if mtime or size changed (PATH is a journal'
+                      ' where later lines for a file override earlier ones)')
+    p.add_option('-r', '--recursive', action='store_true', dest='recursive',
+                 help='hash all files under any FILE that is a directory')
+    p.add_option('--include', action='append', dest='includes',
+                 metavar='PATTERN',
+                 help='with -r, only hash files whose names match PATTERN')
+    p.add_option('--exclude', action='append', dest='excludes',
+                 metavar='PATTERN',
+                 help='with -r, skip files and directories matching PATTERN')
     p.add_option('-a', '--algorithm', dest='algorithm',
-                 help='use ALGORITHM for checksums')
+                 help='use ALGORITHM for checksums, or several'
+                      ' comma-separated algorithms (e.g. md5,sha256)')
+    p.add_option('--chunk-size', dest='chunk_size', type='int',
+                 default=CHUNK_SIZE, metavar='BYTES',
+                 help='read files BYTES at a time (default %default)')
+    p.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                 metavar='N', help='hash up to N files in parallel, and up'
+                                   ' to N ranges of a file with tree hashes')
+    p.add_option('--stats', dest='stats', metavar='PATH',
+                 help="write a JSON report of throughput and timings to"
+                      " PATH ('-' for stderr)")
+    p.add_option('--progress', dest='progress', type='float',
+                 metavar='SECONDS',
+                 help='print a progress line every SECONDS to stderr')
+    p.add_option('--leaf-size', dest='leaf_size', type='int',
+                 default=LEAF_SIZE, metavar='BYTES',
+                 help='split files into ranges of BYTES for tree hash'
+                      ' algorithms such as sha256-tree (default %default)')
 
     g = optparse.OptionGroup(p,
                              'The following options are useful only when'
                              ' verifying checksums')
     g.add_option('-q', '--quiet', action='store_true', dest='quiet',
                  help="don't print OK for each successfully verified file")
+    g.add_option('-o', '--order', type='choice', choices=CHECK_ORDERS,
+                 dest='order', default='listed',
+                 help='read files in ORDER: listed (default), inode, or'
+                      ' extent (physical location from FIEMAP) to reduce'
+                      ' seeking; results are still printed in listed order')
     g.add_option('-s', '--stat-only', action='store_false', dest='do_digest',
                  default=True,
                  help='only check file mtime and size, not hash digest')
@@ -369,18 +2012,89 @@ if __name__ == '__main__':
     p.add_option_group(g)
 
     opts, files = p.parse_args()
-    if not files:
+    if opts.scrub:
+        if not opts.cache_file:
+            p.error('--scrub requires --file')
+        if files:
+            p.error('--scrub takes no FILE arguments')
+        if opts.check_mode or opts.duplicates:
+            p.error('--scrub cannot be used with --check or --duplicates')
+        if not (opts.do_stat and opts.do_digest):
+            p.error('--scrub always checks both mtime/size and digest')
+        try:
+            parse_scrub_amount(opts.scrub)
+        except ValueError, e:
+            p.error('Invalid --scrub amount %r: %s' % (opts.scrub, e))
+    elif opts.max_rate:
+        p.error('--max-rate requires --scrub')
+    elif not files and not (opts.duplicates and opts.cache_file):
         p.error('FILE is required')
+    if opts.max_rate is not None and opts.max_rate <= 0:
+        p.error('--max-rate must be positive')
+    if opts.watch:
+        if not opts.cache_file:
+            p.error('--watch requires --file')
+        if opts.check_mode or opts.duplicates or opts.scrub:
+            p.error('--watch cannot be used with --check, --duplicates or'
+                    ' --scrub')
+        if not all(os.path.isdir(name) for name in files):
+            p.error('--watch requires FILEs to be directories')
+        opts.recursive = True
+    if opts.debounce < 0:
+        p.error('--debounce must not be negative')
+    if opts.jobs < 1:
+        p.error('--jobs must be at least 1')
+    if opts.chunk_size < 1:
+        p.error('--chunk-size must be at least 1')
+    if opts.leaf_size < 1:
+        p.error('--leaf-size must be at least 1')
+    if opts.algorithm:
+        try:
+            parse_algorithms(opts.algorithm)
+        except ValueError, e:
+            p.error(str(e))
+    CHUNK_SIZE = opts.chunk_size
+    LEAF_SIZE = opts.leaf_size
+    TREE_JOBS = opts.jobs
+    if opts.scrub:
+        DROP_CACHE = True
+        if opts.max_rate:
+            THROTTLE = Throttle(opts.max_rate * 10**6)
+
+    if opts.progress is not None and opts.progress <= 0:
+        p.error('--progress must be positive')
+
+    if opts.progress:
+        progress = ProgressReporter(STATS, opts.progress)
+        progress.start()
 
     if opts.check_mode:
         if opts.cache_file:
             p.error('--check and --file are mutually exclusive')
         if opts.algorithm:
             p.error('Algorithm is determined automatically in check mode')
+        if opts.recursive:
+            p.error('--check and --recursive are mutually exclusive')
+        if opts.duplicates:
+            p.error('--check and --duplicates are mutually exclusive')
         runner = CheckRunner(files, opts)
         status = runner.run()
+    elif opts.watch:
+        runner = WatchRunner(files, opts)
+        status = runner.run()
+    elif opts.scrub:
+        runner = ScrubRunner(files, opts)
+        status = runner.run()
+    elif opts.duplicates:
+        runner = DuplicatesRunner(files, opts)
+        status = runner.run()
     else:
         runner = CreateRunner(files, opts)
         status = runner.run()
 
+    if opts.progress:
+        progress.stop()
+    if opts.stats:
+        STATS.write(opts.stats)
+
     sys.exit(status)
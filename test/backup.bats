@@ -0,0 +1,95 @@
+#!/usr/bin/env bats
+set -u
+
+setup() {
+    cd "$BATS_TEST_DIRNAME"
+    bats_load_library "bats-assert"
+    bats_load_library "bats-support"
+    TMP="$(mktemp -d)"
+    mkdir -p "$TMP/bin" "$TMP/remote/daily.0/host" "$TMP/src"
+    echo data > "$TMP/src/file"
+
+    # An ssh that runs commands locally, logging each call. The master
+    # connection just waits until told to exit through its control path.
+    cat > "$TMP/bin/ssh" <<'EOF'
+#!/bin/bash
+master= control= path=
+while [[ $1 == -* ]]; do
+    case $1 in
+        -N) master=1; shift ;;
+        -O) control=$2; shift 2 ;;
+        -o) [[ $2 == ControlPath=* ]] && path=${2#ControlPath=}; shift 2 ;;
+        *) shift ;;
+    esac
+done
+shift
+echo "master=$master control=$control path=$path command=$*" >> "$SSH_LOG"
+if [[ -n $master ]]; then
+    echo $$ > "$path"
+    exec sleep 600
+fi
+case $control in
+    check) [[ -e $path ]]; exit ;;
+    exit) kill "$(cat "$path")"; rm -f "$path"; exit ;;
+esac
+exec sh -c "$*"
+EOF
+    printf '#!/bin/sh\necho "rsync $*" >> "$SSH_LOG"\n' > "$TMP/bin/rsync"
+    chmod +x "$TMP/bin/ssh" "$TMP/bin/rsync"
+    export SSH_LOG="$TMP/log" PATH="$TMP/bin:$PATH"
+}
+
+teardown() {
+    rm -rf "$TMP"
+}
+
+run_backup() {
+    python2 - "$TMP" "$@" <<'EOF'
+import imp, sys
+sys.dont_write_bytecode = True
+backup = imp.load_source('backup', '../backup.py')
+tmp = sys.argv[1]
+backup.SSH = tmp + '/bin/ssh'
+backup.SSH_HOST = 'fake'
+backup.REMOTE_DIR = tmp + '/remote'
+backup.HOST = 'host'
+backup.LOCAL_CHECK_DIR = None
+backup.MANIFEST_DIR = tmp + '/manifests'
+backup.SOURCES = [(tmp + '/src', [])]
+backup.VERBOSE = 0
+backup.check_privs = lambda: None
+sys.argv = ['backup.py'] + sys.argv[2:]
+sys.exit(backup.main())
+EOF
+}
+
+@test "one master connection for the whole run" {
+    run run_backup
+    assert_success
+    [ -d "$TMP/remote/daily.1" ]
+    [ -d "$TMP/remote/daily.0" ]
+
+    run grep -c 'master=1' "$TMP/log"
+    assert_output 1
+    # every other ssh goes through the master's control path
+    run grep -c 'path= ' "$TMP/log"
+    assert_output 0
+    run grep -c 'control=exit' "$TMP/log"
+    assert_output 1
+    run grep '^rsync' "$TMP/log"
+    assert_output --partial '-o ControlPath='
+}
+
+@test "master connection is closed" {
+    run run_backup
+    assert_success
+    run pgrep -f "^sleep 600$"
+    assert_failure
+}
+
+@test "failed master connection" {
+    printf '#!/bin/sh\nexit 255\n' > "$TMP/bin/ssh"
+    run run_backup
+    assert_failure
+    assert_output --partial "Cannot connect to fake"
+}
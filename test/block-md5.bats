@@ -0,0 +1,78 @@
+#!/usr/bin/env bats
+set -u
+
+setup() {
+    cd "$BATS_TEST_DIRNAME"
+    bats_load_library "bats-assert"
+    bats_load_library "bats-support"
+    TMP="$(mktemp -d)"
+}
+
+teardown() {
+    rm -rf "$TMP"
+}
+
+# Sync LOCAL to REMOTE with sync_file and serve_file talking over a
+# socketpair, and print the number of round trips.
+sync_over_socketpair() {
+    python2 - "$@" <<'EOF'
+import imp, socket, sys, threading
+sys.dont_write_bytecode = True
+block_md5 = imp.load_source('block_md5', '../block-md5')
+block_md5.DEBUG = False
+
+local, remote = sys.argv[1:]
+a, b = socket.socketpair()
+server = threading.Thread(target=block_md5.serve_file, args=(
+    open(remote, 'r+'), b.makefile('rb'), b.makefile('wb')))
+server.start()
+channel = block_md5.sync_file(open(local, 'r'), a.makefile('rb'),
+                              a.makefile('wb'))
+server.join()
+print channel.round_trips
+EOF
+}
+
+@test "sync identical files" {
+    head -c 1000000 /dev/urandom > "$TMP/local"
+    cp "$TMP/local" "$TMP/remote"
+    run sync_over_socketpair "$TMP/local" "$TMP/remote"
+    assert_success
+    # hello, the root, and end
+    assert_output 3
+    cmp "$TMP/local" "$TMP/remote"
+}
+
+@test "sync changed blocks" {
+    head -c 3000000 /dev/urandom > "$TMP/local"
+    cp "$TMP/local" "$TMP/remote"
+    printf 'changed' | dd of="$TMP/remote" bs=1 seek=2000000 conv=notrunc
+    run sync_over_socketpair "$TMP/local" "$TMP/remote"
+    assert_success
+    cmp "$TMP/local" "$TMP/remote"
+}
+
+@test "sync to a longer remote file" {
+    head -c 100000 /dev/urandom > "$TMP/local"
+    cat "$TMP/local" "$TMP/local" > "$TMP/remote"
+    run sync_over_socketpair "$TMP/local" "$TMP/remote"
+    assert_success
+    cmp "$TMP/local" "$TMP/remote"
+}
+
+@test "sync to a shorter remote file" {
+    head -c 100000 /dev/urandom > "$TMP/local"
+    head -c 1000 "$TMP/local" > "$TMP/remote"
+    run sync_over_socketpair "$TMP/local" "$TMP/remote"
+    assert_success
+    cmp "$TMP/local" "$TMP/remote"
+}
+
+@test "sync through a serve command" {
+    head -c 500000 /dev/urandom > "$TMP/local"
+    : > "$TMP/remote"
+    run python2 ../block-md5 sync "$TMP/local" \
+        python2 ../block-md5 serve "$TMP/remote"
+    assert_success
+    cmp "$TMP/local" "$TMP/remote"
+}